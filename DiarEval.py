@@ -0,0 +1,429 @@
+import warnings
+
+warnings.filterwarnings('ignore', category=FutureWarning)
+warnings.filterwarnings('ignore', category=UserWarning)
+
+from os import path, listdir
+import argparse
+import csv
+import json
+import sys
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from scipy.optimize import linear_sum_assignment
+
+
+class Settings:
+    resolution = 0.01
+    collar = 0.25
+    skip_overlap = False
+    der_tolerance = 0.005
+    rtf_tolerance = 0.05
+    n_jobs = 1
+    ref_formats = ('.rttm', '.csv')
+    audio_format = '.wav'
+    synthetic_speakers = range(2, 9)
+    synthetic_noises = (0.6, 0.8, 1.0)
+    # Speaker sizes (in frames) of the cases with a small speaker
+    synthetic_small_speakers = ((240, 240, 240, 240, 240, 18), (600, 580, 18))
+
+
+def load_segments(filename):
+    """
+    Reads speaker segments from RTTM or CSV (``start_seg,end_seg,label``) file
+
+    :param filename: path to RTTM or CSV file
+    :return: a list of segments ``[start, end, label]`` (in seconds)
+    """
+    segs = []
+    if filename.lower().endswith('.rttm'):
+        with open(filename) as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) < 8 or fields[0] != 'SPEAKER':
+                    continue
+                start, dur = float(fields[3]), float(fields[4])
+                segs.append([start, start + dur, fields[7]])
+    else:
+        with open(filename, newline="") as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            for row in reader:
+                if len(row) < 3:
+                    continue
+                segs.append([float(row[0]), float(row[1]), row[2]])
+    return segs
+
+
+def segments_to_activity(segs, num_frames, resolution=Settings.resolution):
+    """
+    Converts segments into a binary frame-level speaker activity matrix.
+    Overlapping segments of different speakers are kept as overlap.
+
+    :param segs: a list of segments ``[start, end, label]``
+    :param num_frames: number of frames of the resulting matrix
+    :param resolution: frame step (in seconds)
+    :return: activity matrix (frames x speakers), list of speaker labels
+    """
+    speakers = sorted({str(s[2]) for s in segs})
+    activity = np.zeros((num_frames, len(speakers)), dtype=bool)
+    if len(segs) == 0:
+        return activity, speakers
+
+    spk_ind = {spk: i for i, spk in enumerate(speakers)}
+    cols = np.array([spk_ind[str(s[2])] for s in segs])
+    bounds = np.array([s[:2] for s in segs], dtype=float)
+    starts = np.clip(np.round(bounds[:, 0] / resolution).astype(int), 0, num_frames)
+    ends = np.clip(np.round(bounds[:, 1] / resolution).astype(int), 0, num_frames)
+
+    # Segment borders as +1/-1 steps, the cumulative sum gives the activity
+    steps = np.zeros((num_frames + 1, len(speakers)), dtype=int)
+    np.add.at(steps, (starts, cols), 1)
+    np.add.at(steps, (ends, cols), -1)
+    activity[:] = np.cumsum(steps, axis=0)[:-1] > 0
+    return activity, speakers
+
+
+def collar_mask(segs, num_frames, collar=Settings.collar, resolution=Settings.resolution):
+    """
+    Marks the frames to be scored: frames within ``collar`` seconds around
+    each reference segment border are excluded.
+
+    :return: a boolean vector of scored frames
+    """
+    if collar <= 0 or len(segs) == 0:
+        return np.ones(num_frames, dtype=bool)
+
+    borders = np.array([s[:2] for s in segs], dtype=float).ravel()
+    starts = np.clip(np.round((borders - collar) / resolution).astype(int), 0, num_frames)
+    ends = np.clip(np.round((borders + collar) / resolution).astype(int), 0, num_frames)
+    steps = np.zeros(num_frames + 1, dtype=int)
+    np.add.at(steps, starts, 1)
+    np.add.at(steps, ends, -1)
+    return np.cumsum(steps)[:-1] == 0
+
+
+def score(ref_segs, sys_segs, collar=Settings.collar, skip_overlap=Settings.skip_overlap,
+          resolution=Settings.resolution):
+    """
+    Calculates diarization error components of system output against reference.
+    The optimal speaker mapping is found with Hungarian algorithm on the
+    reference/system confusion matrix.
+
+    :param ref_segs: reference segments ``[start, end, label]``
+    :param sys_segs: system segments ``[start, end, label]``
+    :param collar: no-score zone around reference segment borders (in seconds)
+    :param skip_overlap: exclude reference overlapped speech from scoring
+    :param resolution: frame step (in seconds)
+    :return: a dict with scored speech, missed speech, false alarm and speaker error
+        (in seconds), DER and numbers of speakers
+    """
+    last = max([s[1] for s in ref_segs] + [s[1] for s in sys_segs] + [0.0])
+    num_frames = int(np.ceil(last / resolution)) + 1
+
+    ref, ref_speakers = segments_to_activity(ref_segs, num_frames, resolution)
+    hyp, sys_speakers = segments_to_activity(sys_segs, num_frames, resolution)
+
+    scored = collar_mask(ref_segs, num_frames, collar, resolution)
+    if skip_overlap:
+        scored &= ref.sum(axis=1) <= 1
+    ref = ref[scored]
+    hyp = hyp[scored]
+
+    n_ref = ref.sum(axis=1)
+    n_sys = hyp.sum(axis=1)
+
+    # Confusion matrix: number of frames for each reference/system speaker pair
+    confusion = ref.T.astype(np.int64) @ hyp.astype(np.int64)
+    correct = 0
+    if confusion.size:
+        rows, cols = linear_sum_assignment(-confusion)
+        correct = confusion[rows, cols].sum()
+
+    speech = n_ref.sum()
+    missed = np.maximum(n_ref - n_sys, 0).sum()
+    false_alarm = np.maximum(n_sys - n_ref, 0).sum()
+    speaker_error = np.minimum(n_ref, n_sys).sum() - correct
+    der = (missed + false_alarm + speaker_error) / speech if speech else 0.0
+
+    return {'scored': float(speech * resolution),
+            'missed': float(missed * resolution),
+            'false_alarm': float(false_alarm * resolution),
+            'speaker_error': float(speaker_error * resolution),
+            'der': float(der),
+            'ref_speakers': len(ref_speakers),
+            'sys_speakers': len(sys_speakers)}
+
+
+def score_files(ref_filename, sys_filename, **kwargs):
+    # A missing system output is scored as fully missed speech
+    sys_segs = load_segments(sys_filename) if sys_filename is not None else []
+    return score(load_segments(ref_filename), sys_segs, **kwargs)
+
+
+def find_reference(ref_dir, name):
+    for ext in Settings.ref_formats:
+        ref_filename = path.join(ref_dir, name + ext)
+        if path.isfile(ref_filename):
+            return ref_filename
+    return None
+
+
+def run_system(wav_dir, names):
+    """
+    Runs the diarization for each file of the corpus
+
+    :param wav_dir: directory with input WAVE files
+    :param names: base names of the files
+    :return: a dict ``{name: (result filename, processing time, audio duration)}`` of processed files,
+        a dict ``{name: error message}`` of failed files
+    """
+    from DiarService import process, get_duration
+
+    timings = {}
+    failures = {}
+    for name in names:
+        filename = path.abspath(path.join(wav_dir, name + Settings.audio_format))
+        if not path.isfile(filename):
+            failures[name] = "The file does not exist."
+            continue
+        # process() exits on the files which cannot be loaded
+        try:
+            duration = get_duration(filename)
+            start = time.perf_counter()
+            res_filename, _ = process(filename)
+        except (Exception, SystemExit) as e:
+            failures[name] = str(e) or type(e).__name__
+            continue
+        timings[name] = (res_filename, time.perf_counter() - start, duration)
+    return timings, failures
+
+
+def evaluate(ref_dir, hyp_dir=None, wav_dir=None, n_jobs=Settings.n_jobs, **kwargs):
+    """
+    Evaluates the whole corpus. Each reference file is matched to system output
+    (``hyp_dir``) or to input audio (``wav_dir``) by base name.
+    If ``wav_dir`` is given, the system is run on the audio and timed.
+    References without system output are scored as fully missed speech.
+
+    :param ref_dir: directory with reference RTTM/CSV files
+    :param hyp_dir: directory with ready system outputs (RTTM/CSV)
+    :param wav_dir: directory with input WAVE files
+    :param n_jobs: number of parallel scoring jobs
+    :return: the report: per-file and total accuracy and speed
+    """
+    if (hyp_dir is None) == (wav_dir is None):
+        raise ValueError("Exactly one of 'hyp_dir' and 'wav_dir' should be given.")
+
+    # One entry per reference base name; the files are picked by Settings.ref_formats priority
+    names = sorted({path.splitext(f)[0] for f in listdir(ref_dir)
+                    if path.splitext(f)[1].lower() in Settings.ref_formats})
+
+    timings = {}
+    failures = {}
+    if wav_dir is not None:
+        if any(find_reference(ref_dir, name) == path.join(wav_dir, name + '.csv') for name in names):
+            raise ValueError("CSV references are in 'wav_dir' and would be overwritten by the system outputs.")
+        timings, failures = run_system(wav_dir, names)
+        hyp_files = [timings[name][0] if name in timings else None for name in names]
+    else:
+        hyp_files = [find_reference(hyp_dir, name) for name in names]
+
+    results = Parallel(n_jobs=n_jobs)(delayed(score_files)(find_reference(ref_dir, name), hyp_file, **kwargs)
+                                      for name, hyp_file in zip(names, hyp_files))
+
+    files = {}
+    for name, hyp_file, res in zip(names, hyp_files, results):
+        if name in timings:
+            _, proc_time, duration = timings[name]
+            res['time'] = proc_time
+            res['duration'] = duration
+            res['rtf'] = proc_time / duration if duration else 0.0
+        res['missing'] = hyp_file is None
+        if name in failures:
+            res['error'] = failures[name]
+        files[name] = res
+
+    total = {key: sum(res[key] for res in results) for key in ('scored', 'missed', 'false_alarm', 'speaker_error')}
+    errors = total['missed'] + total['false_alarm'] + total['speaker_error']
+    total['der'] = errors / total['scored'] if total['scored'] else 0.0
+    total['files'] = len(results)
+    total['missing_files'] = sum(res['missing'] for res in results)
+    total['speaker_count_errors'] = sum(res['ref_speakers'] != res['sys_speakers'] for res in results)
+    if timings:
+        total['time'] = sum(t[1] for t in timings.values())
+        total['duration'] = sum(t[2] for t in timings.values())
+        total['rtf'] = total['time'] / total['duration'] if total['duration'] else 0.0
+
+    return {'files': files, 'total': total}
+
+
+def compare(baseline, report, der_tolerance=Settings.der_tolerance, rtf_tolerance=Settings.rtf_tolerance):
+    """
+    Compares the report with the baseline report
+
+    :param der_tolerance: acceptable absolute DER increase
+    :param rtf_tolerance: acceptable relative real-time factor increase
+    :return: True if there is no accuracy or speed regression, list of messages
+    """
+    base, cur = baseline['total'], report['total']
+    accepted = True
+    msgs = []
+    if set(baseline['files']) != set(report['files']):
+        accepted = False
+        msgs.append("The files differ from the baseline: {} missing, {} new".format(
+            len(set(baseline['files']) - set(report['files'])),
+            len(set(report['files']) - set(baseline['files']))))
+
+    if cur['missing_files'] > base.get('missing_files', 0):
+        accepted = False
+        msgs.append("Files without system output: {} -> {}".format(base.get('missing_files', 0),
+                                                                  cur['missing_files']))
+
+    msgs += ["DER: {:.3f}% -> {:.3f}%".format(base['der'] * 100, cur['der'] * 100)]
+    if cur['der'] - base['der'] > der_tolerance:
+        accepted = False
+        msgs.append("DER regression exceeds {:.3f}%".format(der_tolerance * 100))
+
+    if cur['speaker_count_errors'] > base['speaker_count_errors']:
+        accepted = False
+        msgs.append("Speaker count errors: {} -> {}".format(base['speaker_count_errors'],
+                                                            cur['speaker_count_errors']))
+
+    if 'rtf' in base and 'rtf' in cur:
+        msgs.append("RTF: {:.4f} -> {:.4f} (speedup x{:.2f})".format(base['rtf'], cur['rtf'],
+                                                                     base['rtf'] / cur['rtf'] if cur['rtf'] else 0))
+        if cur['rtf'] > base['rtf'] * (1 + rtf_tolerance):
+            accepted = False
+            msgs.append("RTF regression exceeds {:.1f}%".format(rtf_tolerance * 100))
+
+    return accepted, msgs
+
+
+def synthetic_embeddings(num_speakers, noise, seed, num=1200, dim=100, outlier_share=0.03, sizes=None):
+    """
+    Generates L2-normalised embeddings of speakers around random directions.
+    A share of the points has 2.5 times larger noise (outliers).
+
+    :param sizes: numbers of points per speaker (random if not given)
+    :return: the embeddings (float32)
+    """
+    rs = np.random.RandomState(seed)
+    centers = rs.randn(num_speakers, dim)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    if sizes is None:
+        labels = rs.randint(0, num_speakers, num)
+    else:
+        labels = np.repeat(np.arange(num_speakers), sizes)
+        num = len(labels)
+    scale = noise * np.where(rs.rand(num) < outlier_share, 2.5, 1.0)[:, None]
+    emb = centers[labels] + scale * rs.randn(num, dim) / np.sqrt(dim)
+    return (emb / np.linalg.norm(emb, axis=1, keepdims=True)).astype(np.float32)
+
+
+def check_speaker_count(speakers=Settings.synthetic_speakers, noises=Settings.synthetic_noises):
+    """
+    Runs Top2S clustering on fixed-seed synthetic embeddings with known numbers of speakers:
+    speakers of random sizes and sets with one small speaker (``Settings.synthetic_small_speakers``)
+
+    :return: the report: selected and true number of speakers and clustering time per case
+    """
+    from SphereDiar.SphereDiar import Top2S
+
+    configs = []
+    for noise in noises:
+        configs += [(noise, num_speakers, None) for num_speakers in speakers]
+        configs += [(noise, len(sizes), sizes) for sizes in Settings.synthetic_small_speakers]
+
+    cases = []
+    for noise, num_speakers, sizes in configs:
+        for seed in ([num_speakers * 10 + int(noise * 10)] if sizes is None else [1, 2, 3]):
+            emb = synthetic_embeddings(num_speakers, noise, seed, sizes=sizes)
+            start = time.perf_counter()
+            found, _ = Top2S(emb, debug_info=False, random_state=0)
+            cases.append({'noise': noise, 'speakers': num_speakers, 'sizes': sizes, 'found': int(found),
+                          'time': time.perf_counter() - start})
+
+    total = {'cases': len(cases),
+             'speaker_count_errors': sum(c['found'] != c['speakers'] for c in cases),
+             'time': sum(c['time'] for c in cases)}
+    return {'cases': cases, 'total': total}
+
+
+def print_report(report):
+    timed = 'rtf' in report['total']
+    header = "{:<30} {:>8} {:>8} {:>8} {:>8} {:>6}".format('file', 'DER,%', 'MS,%', 'FA,%', 'SE,%', 'spk')
+    print(header + (" {:>8} {:>8}".format('time,s', 'RTF') if timed else ""))
+    for name, res in sorted(report['files'].items()) + [('TOTAL', report['total'])]:
+        scored = res['scored'] if res['scored'] else 1.0
+        line = "{:<30} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}".format(name[:30], res['der'] * 100,
+                                                                   res['missed'] / scored * 100,
+                                                                   res['false_alarm'] / scored * 100,
+                                                                   res['speaker_error'] / scored * 100)
+        if 'ref_speakers' in res:
+            line += " {:>6}".format("{}/{}".format(res['sys_speakers'], res['ref_speakers']))
+        else:
+            line += " {:>6}".format(res['speaker_count_errors'])
+        if timed:
+            line += " {:>8.2f} {:>8.4f}".format(res['time'], res['rtf']) if 'time' in res else " " * 18
+        if res.get('missing'):
+            line += " no output" + (": " + res['error'] if 'error' in res else "")
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Speed and accuracy evaluation of the speaker diarization.")
+    parser.add_argument("ref_dir", nargs="?", help="Directory with reference RTTM/CSV files.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-synthetic", action="store_true",
+                        help="Check the selected number of speakers on fixed-seed synthetic embeddings.")
+    source.add_argument("-hyp_dir", help="Directory with system outputs (RTTM/CSV) to score.")
+    source.add_argument("-wav_dir", help="Directory with WAVE files to process and score. "
+                                         "The outputs will be saved in the same directory.")
+    parser.add_argument("-collar", type=float, default=Settings.collar,
+                        help="No-score zone around reference segment borders (in seconds).")
+    parser.add_argument("-skip_overlap", action="store_true", help="Do not score overlapped speech.")
+    parser.add_argument("-jobs", type=int, default=Settings.n_jobs, help="Number of parallel scoring jobs.")
+    parser.add_argument("-report", help="Path to save the JSON report.")
+    parser.add_argument("-baseline", help="Path to the baseline JSON report to compare with.")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        report = check_speaker_count()
+        for case in report['cases']:
+            print("noise {noise:.1f}: {found}/{speakers} speakers {sizes}, {time:.2f} s".format(
+                **dict(case, sizes=case['sizes'] or "")))
+        print("Speaker count errors: {speaker_count_errors}/{cases}, {time:.2f} s".format(**report['total']))
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+        sys.exit(1 if report['total']['speaker_count_errors'] else 0)
+
+    if args.ref_dir is None:
+        parser.error("the following arguments are required: ref_dir")
+
+    for dn in (args.ref_dir, args.hyp_dir, args.wav_dir):
+        if dn is not None and not path.isdir(dn):
+            print("The directory '{}' does not exist.".format(dn))
+            sys.exit(1)
+
+    report = evaluate(path.abspath(args.ref_dir),
+                      hyp_dir=args.hyp_dir and path.abspath(args.hyp_dir),
+                      wav_dir=args.wav_dir and path.abspath(args.wav_dir),
+                      n_jobs=args.jobs, collar=args.collar, skip_overlap=args.skip_overlap)
+    print_report(report)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            accepted, msgs = compare(json.load(f), report)
+        for msg in msgs:
+            print(msg)
+        print("ACCEPTED" if accepted else "REJECTED")
+        if not accepted:
+            sys.exit(1)
@@ -9,6 +9,7 @@ from magic import magic
 from datetime import datetime
 import csv
 import sys
+import numpy as np
 from wavefile import wavefile
 
 from keras import backend as K
@@ -49,6 +50,11 @@ class Settings:
     mime_type = 'audio/x-wav'
     frame_len = 2
     hop_len = 0.5
+    feature_shape = (201, 59)
+    emb_dim = 1000
+    model_memory = 512 * 1024 ** 2
+    low_memory_chunk = 240
+    low_memory_silh_sample = 2000
     model_path = path.join(path.dirname(path.abspath(__file__)), "SphereDiar", "models", "SphereSpeaker.hdf")
 
 
@@ -66,10 +72,12 @@ def check_file(filename):
     if cur_mime_type != Settings.mime_type:
         return False, "The file format is not WAVE audio"
 
-    (rate, sig) = wavefile.load(path.split(filename)[1])
+    # Only the header is read: the signal is decoded by the admitted job
+    with wavefile.WaveReader(path.split(filename)[1]) as reader:
+        channels, rate = reader.channels, reader.samplerate
 
-    if sig.shape[0] != 1:
-        return False, "The file contains more than one channel (i.e. {}).".format(len(sig))
+    if channels != 1:
+        return False, "The file contains more than one channel (i.e. {}).".format(channels)
 
     if rate != Settings.sample_rate:
         return False, "The file sampling rate is {0} kHz: should be {1} kHz".format(rate / 1000,
@@ -78,6 +86,40 @@ def check_file(filename):
     return True, None
 
 
+def get_duration(filename):
+    """
+    Reads the duration of WAVE file from its header without decoding the signal
+
+    :param filename: path to input file
+    :return: duration (in seconds)
+    """
+    with wavefile.WaveReader(filename) as reader:
+        return reader.frames / reader.samplerate
+
+
+def estimate_memory(duration, low_memory=False):
+    """
+    Estimates the peak memory of the diarization process
+
+    :param duration: duration of the input file (in seconds)
+    :param low_memory: estimate for the low-memory path (see ``diarization``)
+    :return: estimated peak memory (in bytes)
+    """
+    num_frames = max(1, 1 + int((duration - Settings.frame_len) / Settings.hop_len))
+    feat_frames = min(num_frames, Settings.low_memory_chunk) if low_memory else num_frames
+    silh_frames = min(num_frames, Settings.low_memory_silh_sample) if low_memory else num_frames
+
+    signal = duration * Settings.sample_rate * 4
+    # Feature list and its stacked float64 copy, float32 copy for the model input
+    features = feat_frames * Settings.feature_shape[0] * Settings.feature_shape[1] * (8 + 8 + 4)
+    embeddings = num_frames * Settings.emb_dim * 4
+    # Pairwise float32 cosine distances of Top2S and their per-cluster copies in the inner search
+    # (the squared cluster sizes sum to at most silh_frames ** 2)
+    distances = silh_frames ** 2 * 4 * 2
+
+    return int(Settings.model_memory + signal + features + embeddings + distances)
+
+
 def preprocessing(filename):
     """
     Preprocessing and verification of the input file
@@ -96,11 +138,13 @@ def preprocessing(filename):
     return signal
 
 
-def diarization(signal):
+def diarization(signal, low_memory=False):
     """
     The basic process of diarization
 
     :param signal: the signal from input file
+    :param low_memory: extract features and embeddings by chunks of ``Settings.low_memory_chunk`` frames
+        and compute silhouette scores on a sample of ``Settings.low_memory_silh_sample`` embeddings
     :return: the speaker labels, recognized number of speakers
     """
     try:
@@ -109,15 +153,30 @@ def diarization(signal):
         SS_model.load_weights(Settings.model_path)
         SD = SphereDiar(SS_model)
         reporting("The model is loaded.")
-        reporting("Feature extraction...")
-
-        SD.extract_features(signal)
-
-        reporting("Getting embeddings...")
-        SD.get_embeddings()
+        silh_sample_size = None
+        if low_memory:
+            reporting("Feature extraction and getting embeddings by chunks...")
+            frame_size = int(Settings.frame_len * Settings.sample_rate)
+            hop_size = int(Settings.hop_len * Settings.sample_rate)
+            num_frames = 1 + (len(signal) - frame_size) // hop_size
+            embeddings = []
+            for start in range(0, num_frames, Settings.low_memory_chunk):
+                end = min(start + Settings.low_memory_chunk, num_frames)
+                SD.extract_features(signal[start * hop_size:(end - 1) * hop_size + frame_size],
+                                    frame_len=Settings.frame_len, hop_len=Settings.hop_len)
+                embeddings.append(SD.get_embeddings())
+            SD.X_ = []
+            SD.embeddings_ = np.concatenate(embeddings)
+            silh_sample_size = Settings.low_memory_silh_sample
+        else:
+            reporting("Feature extraction...")
+            SD.extract_features(signal, frame_len=Settings.frame_len, hop_len=Settings.hop_len)
+
+            reporting("Getting embeddings...")
+            SD.get_embeddings()
 
         reporting("Clusterization...")
-        SD.cluster(rounds=5, debug_info=DO_REPORT)
+        SD.cluster(debug_info=DO_REPORT, silh_sample_size=silh_sample_size)
 
         reporting(f"Done. Found {SD.opt_speaker_num_} speakers.")
     finally:
@@ -171,12 +230,13 @@ def lab2seg(labels, frame_len=Settings.frame_len, hop_len=Settings.hop_len):
     return segs
 
 
-def process(filename, debug_mode=False):
+def process(filename, debug_mode=False, low_memory=False):
     """
     The full process of speaker diarization
 
     :param debug_mode: print step information if ``debug_mode=True``
     :param filename: path to input file
+    :param low_memory: use the low-memory path of diarization
     :return: the path to csv file with diarization results, recognized number of speakers
     """
     if debug_mode:
@@ -189,7 +249,7 @@ def process(filename, debug_mode=False):
         print(e)
         sys.exit()
 
-    labels, num_of_speakers = diarization(signal)
+    labels, num_of_speakers = diarization(signal, low_memory)
     segments = lab2seg(labels)
     res_filename = create_csv(filename, segments)
     return res_filename, num_of_speakers
@@ -213,6 +273,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("filename", help="Path to input file. The output file will be saved in the same directory.")
     parser.add_argument("-report", action="store_true", help="Enable step-by-step reporting")
+    parser.add_argument("-low_memory", action="store_true", help="Process the file by chunks to save memory")
     args = parser.parse_args()
 
     if not path.exists(args.filename):
@@ -223,6 +284,6 @@ if __name__ == '__main__':
 
     check_res, msg = check_file(args.filename)
     if check_res:
-        process(args.filename)
+        process(args.filename, low_memory=args.low_memory)
     else:
         print(msg)
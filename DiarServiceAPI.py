@@ -1,16 +1,21 @@
 import glob
+import gzip
+import hashlib
 import json
 import os
 import re
+import struct
 import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
 from tempfile import mktemp
 from typing import Dict
 
-from flask import Flask, send_from_directory
+from flask import Flask, make_response, request as http_request
 from flask_restful import Resource, Api, reqparse, inputs
 from werkzeug.datastructures import FileStorage
 
-from DiarService import process, check_file
+from DiarService import process, check_file, get_duration, estimate_memory
 
 
 class Settings:
@@ -18,6 +23,11 @@ class Settings:
     port = 5000
     base_path = '/'
     result_path = '/result'
+    memory_path = '/memory'
+    memory_budget = 4 * 1024 ** 3
+    large_job_share = 0.5
+    gzip_min_size = 512
+    result_index_cache_size = 64
     unsupported_chars_in_filename = r'[/:*?"<>\\|]'
 
 
@@ -27,6 +37,8 @@ class Response:
                                 200: "OK",
                                 400: "Error in the request: there is no '{0}' field in {1}.",
                                 404: "The specified request ID was not found.",
+                                406: "The requested result format is not supported.",
+                                413: "The file requires more memory than the service budget allows.",
                                 500: "An unexpected error occurred while processing the file. "
                                      "You can try again or make another request."}
 
@@ -34,6 +46,9 @@ class Response:
         id = 'id'
         data = 'data'
         num = 'num_speakers'
+        format = 'format'
+        start = 'start'
+        end = 'end'
 
         class Position:
             body = 'body'
@@ -78,6 +93,9 @@ class Request:
         elif class_name == ApiResult.endpoint:
             parser.add_argument(Response.Field.id)
             parser.add_argument(Response.Field.num, type=inputs.boolean)
+            parser.add_argument(Response.Field.format)
+            parser.add_argument(Response.Field.start, type=float)
+            parser.add_argument(Response.Field.end, type=float)
         else:
             raise Exception('Failed to collect RequestParser()')
         return parser.parse_args()
@@ -146,6 +164,219 @@ class Utils:
         return filename
 
 
+class ResultIndex:
+    """
+    Segments of the result CSV file with byte offsets of their lines.
+    The indices of the last ``Settings.result_index_cache_size`` requested results are cached
+    and rebuilt when the result file changes.
+    """
+    cache: 'OrderedDict[str, ResultIndex]' = OrderedDict()
+    lock = threading.Lock()
+
+    def __init__(self, filename):
+        stat = os.stat(filename)
+        self.filename = filename
+        self.version = '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+        self.starts = []
+        self.ends = []
+        self.labels = []
+        self.offsets = []
+        with open(filename, 'rb') as f:
+            offset = len(f.readline())
+            for line in f:
+                row = line.decode().strip().split(',')
+                if len(row) >= 3:
+                    self.offsets.append(offset)
+                    self.starts.append(float(row[0]))
+                    self.ends.append(float(row[1]))
+                    self.labels.append(int(row[2]))
+                offset += len(line)
+        self.offsets.append(offset)
+
+    @staticmethod
+    def get(ID):
+        """
+        :raise FileNotFoundError: if the result file does not exist
+        """
+        filename = os.path.join(Utils.dir_received_files(), ID + Utils.format_result)
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            with ResultIndex.lock:
+                ResultIndex.cache.pop(ID, None)
+            raise
+        version = '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+        with ResultIndex.lock:
+            index = ResultIndex.cache.get(ID)
+            if index is not None and index.version == version:
+                ResultIndex.cache.move_to_end(ID)
+                return index
+
+        # The file is parsed without the lock, so other results are served meanwhile
+        index = ResultIndex(filename)
+        with ResultIndex.lock:
+            ResultIndex.cache[ID] = index
+            ResultIndex.cache.move_to_end(ID)
+            while len(ResultIndex.cache) > Settings.result_index_cache_size:
+                ResultIndex.cache.popitem(last=False)
+        return index
+
+    def window(self, start=None, end=None):
+        """
+        :return: range of the segments overlapping the time window [``start``, ``end``)
+        """
+        first = bisect_right(self.ends, start) if start is not None else 0
+        last = bisect_left(self.starts, end) if end is not None else len(self.starts)
+        return first, max(first, last)
+
+    def read_csv(self, first, last):
+        with open(self.filename, 'rb') as f:
+            header = f.readline()
+            f.seek(self.offsets[first])
+            return header + f.read(self.offsets[last] - self.offsets[first])
+
+
+class ResultFormat:
+    csv = 'csv'
+    rttm = 'rttm'
+    json = 'json'
+    bin = 'bin'
+
+    mime_types = {csv: 'text/csv',
+                  rttm: 'text/x-rttm',
+                  json: 'application/json',
+                  bin: 'application/octet-stream'}
+    rttm_line = 'SPEAKER {0} 1 {1:.3f} {2:.3f} <NA> <NA> {3} <NA> <NA>\n'
+    # Little-endian float32 start, float32 end, uint32 label per segment
+    bin_segment = '<ffI'
+
+    @staticmethod
+    def negotiate(fmt=None):
+        """
+        :return: the format from ``format`` parameter or from Accept header (CSV by default), None if not supported
+        """
+        if fmt is not None:
+            return fmt.lower() if fmt.lower() in ResultFormat.mime_types else None
+        mime_types = list(ResultFormat.mime_types.values())
+        best = http_request.accept_mimetypes.best_match(mime_types) if http_request.accept_mimetypes else mime_types[0]
+        for name, mime_type in ResultFormat.mime_types.items():
+            if mime_type == best:
+                return name
+        return None
+
+    @staticmethod
+    def build(ID, req, fmt, index, first, last):
+        if fmt == ResultFormat.csv:
+            return index.read_csv(first, last)
+        segments = zip(index.starts[first:last], index.ends[first:last], index.labels[first:last])
+        if fmt == ResultFormat.rttm:
+            return ''.join(ResultFormat.rttm_line.format(ID, s, e - s, label) for s, e, label in segments).encode()
+        if fmt == ResultFormat.json:
+            return json.dumps({'id': ID, 'num_speakers': req.num_speakers,
+                               'segments': [list(seg) for seg in segments]}).encode()
+        return b''.join(struct.pack(ResultFormat.bin_segment, *seg) for seg in segments)
+
+    @staticmethod
+    def send(ID, req, args):
+        """
+        Builds the response with the result in the negotiated format, filtered by the time window,
+        compressed with gzip if the client accepts it
+
+        :raise FileNotFoundError: if the result file does not exist
+        :return: the response, None if the format is not supported
+        """
+        fmt = ResultFormat.negotiate(args[Response.Field.format])
+        if fmt is None:
+            return None
+
+        index = ResultIndex.get(ID)
+        first, last = index.window(args[Response.Field.start], args[Response.Field.end])
+        use_gzip = http_request.accept_encodings['gzip'] > 0
+        etag = hashlib.md5('{}:{}:{}:{}:{}'.format(ID, index.version, fmt, first, last).encode()).hexdigest()
+        etag += '-gzip' if use_gzip else ''
+
+        if http_request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            body = ResultFormat.build(ID, req, fmt, index, first, last)
+            if use_gzip and len(body) >= Settings.gzip_min_size:
+                body = gzip.compress(body)
+            else:
+                use_gzip = False
+            response = make_response(body, 200)
+            response.headers['Content-Type'] = ResultFormat.mime_types[fmt]
+            response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(ID, fmt)
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept, Accept-Encoding'
+        return response
+
+
+class AdmissionError(Exception):
+    pass
+
+
+class AdmissionController:
+    """
+    Runs the requests only while their total estimated peak memory fits the budget.
+    The requests are admitted in arrival order; the large ones are switched to the low-memory path.
+    """
+
+    def __init__(self, budget=Settings.memory_budget, large_job_share=Settings.large_job_share):
+        self.budget = budget
+        self.large_job_size = budget * large_job_share
+        self.used = 0
+        self.running: Dict[str, int] = {}
+        self.queue = deque()
+        self.condition = threading.Condition()
+
+    def estimate(self, filename):
+        """
+        :return: estimated peak memory (in bytes), use of low-memory path
+        """
+        duration = get_duration(filename)
+        size = estimate_memory(duration)
+        if size <= self.large_job_size:
+            return size, False
+        return estimate_memory(duration, low_memory=True), True
+
+    def acquire(self, ID, filename):
+        """
+        Blocks until the request fits the memory budget
+
+        :raise AdmissionError: if the request does not fit the budget even alone
+        :return: use of low-memory path
+        """
+        size, low_memory = self.estimate(filename)
+        if size > self.budget:
+            raise AdmissionError(Response.code_msg[413])
+
+        with self.condition:
+            self.queue.append(ID)
+            self.condition.wait_for(lambda: self.queue[0] == ID and self.used + size <= self.budget)
+            self.queue.popleft()
+            self.used += size
+            self.running[ID] = size
+            self.condition.notify_all()
+        return low_memory
+
+    def release(self, ID):
+        with self.condition:
+            self.used -= self.running.pop(ID, 0)
+            self.condition.notify_all()
+
+    def status(self):
+        # Only aggregates: request IDs give access to the results
+        with self.condition:
+            return {'budget': self.budget,
+                    'used': self.used,
+                    'available': self.budget - self.used,
+                    'running': len(self.running),
+                    'waiting': len(self.queue)}
+
+
 class ProcessingRequest(threading.Thread):
     def __init__(self, id_request, audio_filename):
         threading.Thread.__init__(self, name=Request.thread_name(id_request))
@@ -159,8 +390,17 @@ class ProcessingRequest(threading.Thread):
         self.request.status = 202
         self.request.to_json(self.ID)
         try:
-            _, num_of_speakers = process(self.filename, debug_mode=DEBUG_MODE)
+            low_memory = admission.acquire(self.ID, self.filename)
+            try:
+                _, num_of_speakers = process(self.filename, debug_mode=DEBUG_MODE, low_memory=low_memory)
+            finally:
+                admission.release(self.ID)
             self.request.num_speakers = int(num_of_speakers)
+        except AdmissionError as e:
+            self.error_str = str(e)
+            self.error = True
+            self.request.status = 413
+            self.request.message = self.error_str
         except Exception as e:
             if DEBUG_MODE:
                 print('{}: '.format(self.ID), e)
@@ -216,10 +456,13 @@ class ApiResult(Resource):
                 if code == 201:
                     if num_speakers is not None and num_speakers is True:
                         return Response.build(ID, code, str(req.num_speakers))
-                    else:
-                        return send_from_directory(Utils.dir_received_files(),
-                                                   ID + Utils.format_result,
-                                                   as_attachment=True)
+                    try:
+                        response = ResultFormat.send(ID, req, args)
+                    except FileNotFoundError:
+                        return Response.build(ID, 404)
+                    if response is not None:
+                        return response
+                    code = 406
             else:
                 code = 404
         else:
@@ -228,11 +471,19 @@ class ApiResult(Resource):
         return Response.build(ID, code, msg, field_name=Response.Field.id, field_pos=Response.Field.Position.params)
 
 
+class ApiMemory(Resource):
+    def get(self):
+        return admission.status(), 200
+
+
+admission = AdmissionController()
+
 app = Flask(__name__)
 api = Api(app)
 
 api.add_resource(ApiBase, Settings.base_path)
 api.add_resource(ApiResult, Settings.result_path)
+api.add_resource(ApiMemory, Settings.memory_path)
 
 DEBUG_MODE = True
 
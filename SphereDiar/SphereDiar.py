@@ -1,5 +1,6 @@
 from MulticoreTSNE import MulticoreTSNE as TSNE
 from joblib import Parallel, delayed
+from scipy.optimize import linear_sum_assignment
 from keras.layers import *
 from keras.models import *
 from librosa.feature import *
@@ -7,9 +8,8 @@ from librosa.util import frame, exceptions
 from matplotlib import pyplot as plt
 from matplotlib.pyplot import cm
 from sklearn import preprocessing
-from sklearn.metrics import silhouette_score
 from sklearn.preprocessing import LabelEncoder
-from sklearn.utils import linear_assignment_
+from sklearn.utils import check_random_state
 from spherecluster import SphericalKMeans
 
 
@@ -32,24 +32,11 @@ def feature_extractor(s, fs=16000):
 
 def reorganize_lab(emb_labels):
 
-    new_labels = np.zeros(len(emb_labels))
-    elements, counts = np.unique(emb_labels, return_counts=True)
-    indices = np.argsort(-np.abs(counts))
-    for i, ind in enumerate(indices):
-        emb_ind = np.where(emb_labels == elements[ind])[0]
-        new_labels[emb_ind] = np.ones(len(emb_ind)) * i
-    return new_labels
-
-
-def silh_score(emb, guess, mode=0):
-
-    spkmeans = SphericalKMeans(n_clusters=guess, max_iter=300, n_init=1, n_jobs=1).fit(emb)
-    emb_labels = spkmeans.labels_
-    centers = spkmeans.cluster_centers_
-    if mode == 0:
-        return silhouette_score(emb, emb_labels, metric="cosine"), emb_labels, centers
-    else:
-        return silhouette_score(emb, emb_labels, metric="cosine")
+    # Relabel clusters by decreasing size
+    elements, inverse, counts = np.unique(emb_labels, return_inverse=True, return_counts=True)
+    ranks = np.empty(len(elements), dtype=int)
+    ranks[np.argsort(-counts, kind="stable")] = np.arange(len(elements))
+    return ranks[inverse.ravel()].astype(float)
 
 
 def DER(ref_labels, labels):
@@ -58,26 +45,190 @@ def DER(ref_labels, labels):
     ref_labels = LabelEncoder().fit_transform(ref_labels)
 
     # Reorganize
-    labels = reorganize_lab(labels)
-
-    # Calculate DER with Hungarian algorithm
-    k = np.unique(ref_labels).size
-    G = np.zeros((k, k))
-    for i in range(k):
-        lbl = ref_labels[labels[0:len(ref_labels)] == i]
-        elements, counts = np.unique(lbl, return_counts=True)
-        for index, element in enumerate(elements):
-            G[i, element] = -counts[index]
-    A = linear_assignment_.linear_assignment(G)
-    acc = 0.0
-    for (cluster, best) in A:
-        acc -= G[cluster, best]
+    labels = reorganize_lab(labels).astype(int)[0:len(ref_labels)]
+
+    # Calculate DER with Hungarian algorithm on the confusion matrix
+    G = np.zeros((labels.max() + 1, ref_labels.max() + 1))
+    np.add.at(G, (labels, ref_labels[0:len(labels)]), 1)
+    rows, cols = linear_sum_assignment(-G)
+    acc = G[rows, cols].sum()
 
     return 1 - acc / float(len(ref_labels))
 
 
+def cosine_dist(emb):
+
+    # Pairwise cosine distances of L2-normalised embeddings, computed in place
+    dist = np.dot(emb, emb.T)
+    np.subtract(1, dist, out=dist)
+    np.clip(dist, 0, 2, out=dist)
+    np.fill_diagonal(dist, 0)
+    return dist
+
+
+def fast_silhouette(dist, labels, n_clusters=2, cohesive=False):
+
+    # Mean silhouette coefficient from precomputed distances (as sklearn silhouette_score);
+    # configurations with clusters missing from the labels are rejected, and if cohesive,
+    # also those with a cluster of non-positive mean silhouette (e.g. scattered outliers)
+    elements, labels = np.unique(labels, return_inverse=True)
+    if not max(2, n_clusters) <= len(elements) <= len(labels) - 1:
+        return -1
+    # one_hot of the same dtype as dist, so np.dot does not copy dist
+    one_hot = np.zeros((len(labels), len(elements)), dtype=dist.dtype)
+    one_hot[np.arange(len(labels)), labels] = 1
+    counts = one_hot.sum(axis=0)
+    mean_dist = np.dot(dist, one_hot)
+    mean_dist /= counts
+    own = counts[labels]
+
+    a = mean_dist[np.arange(len(labels)), labels] * own / np.maximum(own - 1, 1)
+    mean_dist[np.arange(len(labels)), labels] = np.inf
+    b = mean_dist.min(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        silh = np.nan_to_num((b - a) / np.maximum(a, b))
+    silh[own == 1] = 0
+    if cohesive and np.min(np.bincount(labels, weights=silh) / counts) <= 0:
+        return -1
+    return np.mean(silh)
+
+
+def spherical_kmeans(emb, centers, max_iter=300):
+
+    # Lloyd iterations on the unit sphere, starting from given centers
+    centers = preprocessing.normalize(centers)
+    labels = None
+    for _ in np.arange(max_iter):
+        sims = np.dot(emb, centers.T)
+        new_labels = np.argmax(sims, axis=1)
+
+        # Empty clusters get the points which fit their centers worst
+        counts = np.bincount(new_labels, minlength=len(centers))
+        empty = np.where(counts == 0)[0]
+        if len(empty) > 0:
+            worst = np.argsort(sims[np.arange(len(emb)), new_labels])[:len(empty)]
+            new_labels[worst] = empty[:len(worst)]
+
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+
+        one_hot = np.zeros((len(emb), len(centers)), dtype=emb.dtype)
+        one_hot[np.arange(len(emb)), labels] = 1
+        sums = np.dot(one_hot.T, emb)
+        nonempty = np.linalg.norm(sums, axis=1) > 0
+        centers[nonempty] = preprocessing.normalize(sums[nonempty])
+
+    return labels, centers
+
+
+def bisect_cluster(points, n_iter=20):
+
+    # Pairs of centers from two halves of the cluster along its principal direction
+    # (power iteration from the farthest point), refined by spherical 2-means within the cluster
+    centred = points - points.mean(axis=0)
+    direction = centred[np.argmax(np.einsum("ij,ij->i", centred, centred))]
+    for _ in np.arange(n_iter):
+        direction = np.dot(centred.T, np.dot(centred, direction))
+        norm = np.linalg.norm(direction)
+        if norm == 0:
+            return []
+        direction /= norm
+
+    # The halves are cut at the mean and where the within-half variance of the projections
+    # is minimal (1-D 2-means): a small group far along the direction is then separated from the rest
+    proj = np.dot(centred, direction)
+    sorted_proj = np.sort(proj)
+    left_sums = np.cumsum(sorted_proj)[:-1]
+    left_sizes = np.arange(1, len(proj))
+    right_sums = left_sums[-1] + sorted_proj[-1] - left_sums
+    between = left_sums ** 2 / left_sizes + right_sums ** 2 / left_sizes[::-1]
+    cuts = [0, sorted_proj[np.argmax(between)]]
+
+    halves = []
+    for i, cut in enumerate(cuts):
+        side = proj > cut
+        if side.all() or not side.any() or (i > 0 and np.array_equal(side, proj > cuts[0])):
+            continue
+        seeds = np.vstack([points[side].mean(axis=0), points[~side].mean(axis=0)])
+        halves.append(spherical_kmeans(points, seeds)[1])
+    return halves
+
+
+def split_cluster(emb, labels, centers, n_splits=3):
+
+    # Candidate K + 1 centers: each of the n_splits clusters with the highest dispersion is bisected
+    dist = 1 - np.sum(emb * centers[labels], axis=1)
+    dispersion = np.bincount(labels, weights=dist, minlength=len(centers))
+    candidates = []
+    for speaker in np.argsort(-dispersion)[:n_splits]:
+        speaker_ind = np.where(labels == speaker)[0]
+        if len(speaker_ind) < 2:
+            continue
+        for halves in bisect_cluster(emb[speaker_ind]):
+            candidates.append(np.vstack([np.delete(centers, speaker, axis=0), halves]))
+    return candidates
+
+
+def silh_sweep(emb, dist, clust_range, sample=None, n_splits=3, min_cluster_size=2):
+
+    # Clusterings for K = 2, ..., clust_range[1] - 1, each warm-started from the K - 1 centers
+    # by the best of several cluster splits. Splits leaving a cluster smaller than min_cluster_size
+    # points, a cluster of non-positive mean silhouette or a degenerate silhouette are rejected
+    # and never used as the start of K + 1.
+    # Returns (silhouette score, labels, centers) for K in clust_range, (-1, None, None) if not found
+    if sample is None:
+        sample = np.arange(len(emb))
+    labels = np.zeros(len(emb), dtype=int)
+    centers = preprocessing.normalize(emb.mean(axis=0, keepdims=True))
+
+    configs = []
+    for K in np.arange(2, clust_range[1]):
+        candidates = split_cluster(emb, labels, centers, n_splits) if K <= len(emb) else []
+        score = -1
+        best = None
+        for init in candidates:
+            cand_labels, cand_centers = spherical_kmeans(emb, init)
+            if np.bincount(cand_labels, minlength=K).min() < min_cluster_size:
+                continue
+            cand_score = fast_silhouette(dist, cand_labels[sample], n_clusters=K, cohesive=True)
+            if cand_score > score:
+                score = cand_score
+                best = cand_labels, cand_centers
+        if best is None:
+            configs.extend([(-1, None, None)] * (clust_range[1] - max(K, clust_range[0])))
+            break
+        labels, centers = best
+
+        if K >= clust_range[0]:
+            configs.append((score, labels, centers))
+
+    return configs
+
+
+def inner_silh(emb, dist, in_sample, clust_range):
+
+    # Silhouette values of one speaker cluster, distances restricted to its sampled points
+    pos = in_sample[in_sample >= 0]
+    sample = np.where(in_sample >= 0)[0]
+    return [config[0] for config in silh_sweep(emb, dist[np.ix_(pos, pos)], clust_range, sample=sample)]
+
+
 def Top2S(embeddings, threshold=0.10, rounds=25,
-          clust_range=[2, 12], num_cores=1, debug_info=True):
+          clust_range=[2, 12], num_cores=1, debug_info=True, sample_size=None, random_state=None):
+
+    # The warm-started sweep is deterministic, so it runs once: rounds is kept for
+    # compatibility and does not change the result. random_state only selects the sample
+    random_state = check_random_state(random_state)
+    emb = preprocessing.normalize(np.asarray(embeddings, dtype=np.float32))
+
+    # Distances are computed once; on a random subset if sample_size is given
+    sample = np.arange(len(emb))
+    if sample_size is not None and sample_size < len(emb):
+        sample = np.sort(random_state.choice(len(emb), sample_size, replace=False))
+    dist = cosine_dist(emb[sample])
+    in_sample = np.full(len(emb), -1)
+    in_sample[sample] = np.arange(len(sample))
 
     ## STEP 1: Proposal generation
     label_dict = {}
@@ -89,19 +240,15 @@ def Top2S(embeddings, threshold=0.10, rounds=25,
         score_dict[i] = 0
         center_dict[i] = 0
 
-    for i in np.arange(rounds):
-        if debug_info:
-            print("Clustering round: ", i)
-        # Creates clustering configurations
-        round_configs = Parallel(n_jobs=num_cores)(delayed(silh_score)(embeddings, K)
-                                                   for K in np.arange(clust_range[0], clust_range[1]))
-
-        # Update cluster centers, silhouette scores and labels
-        for i, config in enumerate(round_configs):
-            if score_dict[i + clust_range[0]] < config[0]:
-                score_dict[i + clust_range[0]] = config[0]
-                label_dict[i + clust_range[0]] = config[1]
-                center_dict[i + clust_range[0]] = config[2]
+    if debug_info:
+        print("Clustering sweep")
+    # Creates clustering configurations, keeps cluster centers, silhouette scores and labels
+    configs = silh_sweep(emb, dist, clust_range, sample=sample)
+    for K, config in zip(np.arange(clust_range[0], clust_range[1]), configs):
+        if score_dict[K] < config[0]:
+            score_dict[K] = config[0]
+            label_dict[K] = config[1]
+            center_dict[K] = config[2]
 
     silh_scores = []
     for i in np.arange(2, clust_range[1]):
@@ -118,22 +265,18 @@ def Top2S(embeddings, threshold=0.10, rounds=25,
         return K_top_1, center_dict
 
     # Optional inner cluster search
+    if debug_info:
+        print("Inner clustering sweep")
+    speaker_inds = [np.where(labels == speaker)[0] for speaker in np.arange(K_top_1)]
+    inner_values = Parallel(n_jobs=num_cores, prefer="threads")(
+        delayed(inner_silh)(emb[speaker_ind], dist, in_sample[speaker_ind], clust_range)
+        for speaker_ind in speaker_inds)
+
     found_in_clusters = False
-    for i in np.arange(rounds):
-        if found_in_clusters:
+    for silh_values in inner_values:
+        if (np.argmax(silh_values) <= 2) and (np.max(silh_values) > threshold):
+            found_in_clusters = True
             break
-        if debug_info:
-            print("Inner clustering round: ", i)
-
-        for speaker in np.arange(K_top_1):
-            speaker_ind = np.where(labels == speaker)[0]
-            silh_values = Parallel(n_jobs=num_cores)(delayed(silh_score)(embeddings[speaker_ind],
-                                                                         K, mode=1)
-                                                     for K in np.arange(clust_range[0], clust_range[1]))
-
-            if (np.argmax(silh_values) <= 2) and (np.max(silh_values) > threshold):
-                found_in_clusters = True
-                break
 
     if not found_in_clusters:
         K_top_2 = K_top_1
@@ -185,7 +328,7 @@ class SphereDiar:
         return embeddings
 
     def cluster(self, rounds=20, clust_range=[2, 12], num_cores=1,
-                threshold=0.1, embeddings=[], debug_info=True):
+                threshold=0.1, embeddings=[], debug_info=True, silh_sample_size=None):
 
         if (len(self.embeddings_) == 0) and (len(embeddings) == 0):
             raise RuntimeError("No speaker embeddings available.")
@@ -199,7 +342,8 @@ class SphereDiar:
 
         # Top Two Silhouettes
         opt_center_num, center_dict = Top2S(embeddings, clust_range=clust_range, rounds=rounds,
-                                            num_cores=num_cores, threshold=threshold, debug_info=debug_info)
+                                            num_cores=num_cores, threshold=threshold, debug_info=debug_info,
+                                            sample_size=silh_sample_size)
         self.centers_ = center_dict
         self.opt_speaker_num_ = opt_center_num
 